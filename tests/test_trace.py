@@ -1,5 +1,11 @@
+import io
 import os
 import sys
+import heapq
+import struct
+import mmap
+import pickle
+import subprocess
 import pytest
 
 TEST_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -8,7 +14,7 @@ TEST_INPUT_DIR = os.path.join(TEST_ROOT, 'testing_inputs')
 
 sys.path.insert(0, PROJECT_ROOT)
 
-from wltrace import wltrace, dot11
+from wltrace import wltrace, dot11, peektagged, fusion, common
 
 
 def test_pcap():
@@ -110,6 +116,37 @@ def test_pkt():
     assert pkt.ack_pkt.counter == 2
 
 
+def test_no_inference():
+    path = os.path.join(TEST_INPUT_DIR, 'trace.pkt')
+    trace = wltrace.load_trace(path, infer_acked=False, infer_retry=False)
+    pkts = list(trace)
+
+    assert len(pkts) == 10
+
+    pkt = pkts[0]
+    assert not pkt.acked
+    assert pkt.ack_pkt is None
+    assert not hasattr(pkt, 'retry_count')
+
+
+def test_pickle():
+    path = os.path.join(TEST_INPUT_DIR, 'trace.pcap')
+    pkt = next(iter(wltrace.load_trace(path)))
+
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        copy = pickle.loads(pickle.dumps(pkt, protocol))
+        assert copy == pkt
+        assert copy.src == pkt.src
+        assert copy.seq_num == pkt.seq_num
+        assert copy.phy.mactime == pkt.phy.mactime
+
+
+def test_phy_info_unknown_field():
+    assert common.PhyInfo(signal=-40).signal == -40
+    with pytest.raises(TypeError):
+        common.PhyInfo(sigal=-40)
+
+
 def test_non_radiotap():
     path = os.path.join(TEST_INPUT_DIR, 'non_radiotap.pcap')
     assert wltrace.is_packet_trace(path)
@@ -118,3 +155,144 @@ def test_non_radiotap():
     pkts = list(trace)
 
     assert len(pkts) == 2001
+
+
+def test_handler():
+    path = os.path.join(TEST_INPUT_DIR, 'trace.pkt')
+    handler = wltrace.get_handler(path)
+    assert handler is wltrace.peektagged.PeektaggedCapture
+    assert wltrace.get_handler(os.path.abspath(__file__)) is None
+
+    pkts = list(wltrace.load_trace(path, handler=handler))
+    assert len(pkts) == 10
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='no FIFO support')
+def test_handler_not_regular_file(tmpdir):
+    # must not block waiting for a writer
+    fifo = str(tmpdir.join('fifo'))
+    os.mkfifo(fifo)
+    assert wltrace.get_handler(fifo) is None
+    assert not wltrace.is_packet_trace(fifo)
+
+    assert wltrace.get_handler(str(tmpdir)) is None
+    assert wltrace.get_handler(str(tmpdir.join('missing'))) is None
+
+
+def test_no_mmap():
+    path = os.path.join(TEST_INPUT_DIR, 'trace.pcap')
+    trace = wltrace.load_trace(path, mmap=False)
+    assert not isinstance(trace.fh, mmap.mmap)
+
+    pkts = list(trace)
+    assert len(pkts) == 318
+    assert pkts == list(wltrace.load_trace(path))
+
+
+@pytest.mark.parametrize('name', ['trace.pcap', 'trace.pkt'])
+def test_fh_without_fileno(name):
+    path = os.path.join(TEST_INPUT_DIR, name)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    handler = wltrace.get_handler(path)
+    trace = wltrace.load_trace(path, handler=handler, fh=io.BytesIO(data))
+    assert not isinstance(trace.fh, mmap.mmap)
+    assert list(trace) == list(wltrace.load_trace(path))
+
+
+def test_close():
+    path = os.path.join(TEST_INPUT_DIR, 'trace.pcap')
+    pkts = list(wltrace.load_trace(path))
+
+    with wltrace.load_trace(path) as trace:
+        assert next(trace) == pkts[0]
+    assert trace.fh is None
+
+    # what is already queued is still handed out, nothing more is read
+    trace = wltrace.load_trace(path, fetch_size=16)
+    first = next(trace)
+    trace.close()
+    assert trace.fh is None
+    assert [first] + list(trace) == pkts[:16]
+    trace.close()
+
+    trace = wltrace.load_trace(path)
+    list(trace)
+    assert trace.fh is None
+
+
+def test_iter_batches():
+    path = os.path.join(TEST_INPUT_DIR, 'trace.pkt')
+    pkts = list(wltrace.load_trace(path))
+
+    trace = wltrace.load_trace(path)
+    batches = [(dict((k, v.copy()) for k, v in fields.items()), batch)
+               for fields, batch in trace.iter_batches(4)]
+    assert [len(batch) for _, batch in batches] == [4, 4, 2]
+    assert sum([batch for _, batch in batches], []) == pkts
+
+    fields, batch = batches[0]
+    assert len(fields['seq_num']) == 4
+    # acks carry no sequence number
+    assert list(fields['seq_num']) ==\
+        [-1 if p.seq_num is None else p.seq_num for p in batch]
+    assert list(fields['acked']) == [p.acked for p in batch]
+    assert list(fields['retry_count']) == [p.retry_count for p in batch]
+
+
+def test_peektagged_repeated_signed_tag():
+    tlvs = [(0x00, 100), (0x01, 0), (0x02, 0), (0x03, 0), (0x05, 12),
+            (0x07, 2 ** 32 - 50), (0x07, 2 ** 32 - 60), (0xffff, 100)]
+    raw = ''.join(struct.pack('<HI', tag, val) for tag, val in tlvs)
+    header = peektagged.PeektaggedPacketHeader(io.BytesIO(raw))
+
+    # the last one wins, converted to signed once
+    assert header.signal == -60
+    assert header.caplen == 100
+
+
+def test_fusion_merge_non_monotonic():
+    class Pkt(object):
+
+        def __init__(self, mactime):
+            self.phy = common.PhyInfo(mactime=mactime)
+
+    # mactime goes backwards within both slices, e.g., after a TSF reset
+    pkts1 = [Pkt(m) for m in [50, 10, None, 30, 30]]
+    pkts2 = [Pkt(m) for m in [40, 20, 30, None, 5]]
+
+    merged = [p for _, _, _, p in heapq.merge(
+        fusion.by_mactime(pkts1, 0), fusion.by_mactime(pkts2, 1))]
+    # same as a stable sort of both slices, without the packets that have no
+    # mactime
+    expected = [p for p in sorted(pkts1 + pkts2, key=lambda p: p.phy.mactime)
+                if p.phy.mactime is not None]
+    assert merged == expected
+
+
+@pytest.mark.parametrize('module', ['dot11', 'fusion', 'peektagged', 'pcap',
+                                    'wltrace'])
+def test_import_first(module):
+    # common and dot11 import each other, make sure either can come first
+    code = 'import sys; sys.path.insert(0, %r); from wltrace import %s' %\
+        (PROJECT_ROOT, module)
+    subprocess.check_call([sys.executable, '-c', code])
+
+    assert common._INFERABLE_TYPES == frozenset(
+        [dot11.DOT11_TYPE_MANAGEMENT, dot11.DOT11_TYPE_DATA])
+
+
+def test_fusion_script():
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            [sys.executable, os.path.join(PROJECT_ROOT, 'wltrace',
+                                          'fusion.py'), '--help'],
+            stdout=devnull)
+
+
+def test_import_without_numpy():
+    # only WlTrace.iter_batches needs numpy
+    code = ('import sys; sys.path.insert(0, %r); from wltrace import wltrace; '
+            'assert "numpy" not in sys.modules' % (PROJECT_ROOT, ))
+    subprocess.check_call([sys.executable, '-c', code])
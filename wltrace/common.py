@@ -1,11 +1,39 @@
 """Common interfaces.
 """
 
-import struct
-import abc
+import os
 import io
+import mmap
+import itertools
 import collections
 
+import utils
+
+READ_BUFFER_SIZE = 128 * 1024
+"""Default read buffer size in bytes, used when the trace file can not be
+memory-mapped.
+"""
+
+FETCH_SIZE = 4096
+"""Default number of packets parsed at a time by :class:`WlTrace`.
+"""
+
+BATCH_FIELDS = [
+    # (field, dtype, value if missing)
+    ('src', 'O', None),
+    ('dest', 'O', None),
+    ('type', 'i1', -1),
+    ('seq_num', 'i4', -1),
+    ('retry', '?', False),
+    ('acked', '?', False),
+    ('retry_count', 'i4', -1),
+    ('epoch_ts', 'f8', float('nan')),
+    ('end_epoch_ts', 'f8', float('nan')),
+]
+"""Packet fields gathered into arrays by :meth:`WlTrace.iter_batches`, as
+NumPy dtype strings.
+"""
+
 
 class GenericHeader(object):
     """Base class for general header structure.
@@ -32,25 +60,49 @@ class GenericHeader(object):
     the same name for multiple dummy fields.
     """
 
+    __slots__ = ('payload', )
+    """Subclasses with a fixed set of attributes can declare their own
+    ``__slots__`` (e.g., ``tuple(FIELDS)``) to avoid a per-instance
+    ``__dict__``.  Subclasses that do not will get a ``__dict__`` as usual.
+    """
+
     def __init__(self, fh, *args, **kwargs):
         cls = self.__class__
-        header_len = struct.calcsize(cls.PACK_PATTERN)
-        raw = fh.read(header_len)
-        if len(raw) != header_len:
+        s = utils.get_struct(cls.PACK_PATTERN)
+        raw = fh.read(s.size)
+        if len(raw) != s.size:
             raise IOError('Short read bytes, excect %d, got %d' %
-                          (header_len, len(raw)))
+                          (s.size, len(raw)))
 
         self.payload = raw
-        self.offset = 0
 
-        fields = self.unpack(cls.PACK_PATTERN)
-        for i, attr in enumerate(cls.FIELDS):
-            setattr(self, attr, fields[i])
+        for attr, val in zip(cls.FIELDS, s.unpack(raw)):
+            setattr(self, attr, val)
 
-    def unpack(self, fmt):
-        val = struct.unpack_from(fmt, self.payload, self.offset)
-        self.offset += struct.calcsize(fmt)
-        return val
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in self.__class__.__mro__:
+            for attr in cls.__dict__.get('__slots__', ()):
+                if attr != '__dict__' and hasattr(self, attr):
+                    state[attr] = getattr(self, attr)
+        return state
+
+    def __setstate__(self, state):
+        for attr, val in state.items():
+            setattr(self, attr, val)
+
+    def unpack(self, fmt, offset):
+        """Unpack ``fmt`` from ``self.payload``.
+
+        Args:
+            fmt (str): :mod:`struct` format.
+            offset (int): where to start in ``self.payload``.
+
+        Returns:
+            tuple: the unpacked values, and the offset right after them.
+        """
+        s = utils.get_struct(fmt)
+        return s.unpack_from(self.payload, offset), offset + s.size
 
 
 class PhyInfo(object):
@@ -75,15 +127,43 @@ class PhyInfo(object):
     * last_frame (bool): True if this packet was the last packet in the AMPDU.
     """
 
-    def __init__(self, *args, **kwargs):
-        for attr in ['signal', 'noise', 'freq_mhz', 'has_fcs', 'fcs_error',
-                     'epoch_ts', 'end_epoch_ts', 'rate', 'mcs', 'len', 'caplen',
-                     'mactime', 'ampdu_ref', 'last_frame']:
-            setattr(self, attr, kwargs.get(attr, None))
+    __slots__ = ('signal', 'noise', 'freq_mhz', 'has_fcs', 'fcs_error',
+                 'epoch_ts', 'end_epoch_ts', 'rate', 'mcs', 'len', 'caplen',
+                 'mactime', 'ampdu_ref', 'last_frame')
+
+    def __init__(self, signal=None, noise=None, freq_mhz=None, has_fcs=None,
+                 fcs_error=None, epoch_ts=None, end_epoch_ts=None, rate=None,
+                 mcs=None, len=None, caplen=None, mactime=None, ampdu_ref=None,
+                 last_frame=None):
+        self.signal = signal
+        self.noise = noise
+        self.freq_mhz = freq_mhz
+        self.has_fcs = has_fcs
+        self.fcs_error = fcs_error
+        self.epoch_ts = epoch_ts
+        self.end_epoch_ts = end_epoch_ts
+        self.rate = rate
+        self.mcs = mcs
+        self.len = len
+        self.caplen = caplen
+        self.mactime = mactime
+        self.ampdu_ref = ampdu_ref
+        self.last_frame = last_frame
+
+    def __reduce__(self):
+        return (PhyInfo, tuple(getattr(self, attr)
+                               for attr in PhyInfo.__slots__))
 
 
 import dot11
 
+_INFERABLE_TYPES = frozenset([0, 2])
+"""Packet types ``acked`` and ``retry_count`` can be inferred for, when sent
+to a unicast address: :data:`dot11.DOT11_TYPE_MANAGEMENT` and
+:data:`dot11.DOT11_TYPE_DATA`. Spelled out, because ``dot11`` may still be
+half imported at this point.
+"""
+
 
 class WlTrace(object):
     """Base class that represents a (wireless) packet trace.
@@ -97,6 +177,23 @@ class WlTrace(object):
 
     Args:
         path (str): the path of the packet trace file.
+        fh (file object): optional, ``path`` already opened in binary mode. The
+          trace takes over the file object. It needs ``read``, ``seek`` and
+          ``tell``. Objects without a ``fileno``, e.g., :class:`io.BytesIO`,
+          are read from directly, without memory-mapping or extra buffering.
+        mmap (bool): memory-map the file instead of reading it through a
+          buffer. Default is ``True``. Falls back to buffered reads if the
+          file can not be mapped, e.g., it is empty.
+        buffer_size (int): read buffer size in bytes, in case the file is not
+          memory-mapped. Default is :data:`READ_BUFFER_SIZE`.
+        infer_acked (bool): infer ``pkt.acked`` and ``pkt.ack_pkt`` from the
+          following packets. Default is ``True``.
+        infer_retry (bool): infer ``pkt.retry_count`` from the following
+          packets. Default is ``True``.
+        fetch_size (int): number of packets to parse at a time. The queue is
+          refilled once less than :attr:`REFILL_THRESHOLD` packets are left,
+          which is also the least number of packets looked ahead for
+          inference. Default is :data:`FETCH_SIZE`.
 
     Example:
         This is how ``WlTrace`` is supposed to be used::
@@ -104,28 +201,97 @@ class WlTrace(object):
           cap = WlTrace('path/to/packet/trace.pcap')
           for pkt in cap:
             print pkt.counter
+
+        If the trace may not be read to the end, use it as a context manager
+        or call :meth:`close`::
+
+          with WlTrace('path/to/packet/trace.pcap') as cap:
+            first = next(cap)
+    """
+
+    REFILL_THRESHOLD = None
+    """Refill the queue once fewer packets than this are left. ``None`` means
+    1/8 of ``fetch_size``. Subclasses can override it, at least 2 packets are
+    always kept for inference to look ahead.
     """
-    __metaclass__ = abc.ABCMeta
 
     def __init__(self, path, *args, **kwargs):
         super(WlTrace, self).__init__()
 
         self.path = path
-        self.fh = io.BufferedReader(io.open(path, 'rb'))
+        f = kwargs.get('fh')
+        if f is None:
+            f = io.open(path, 'rb', buffering=0)
+
+        try:
+            fileno = f.fileno()
+        except (AttributeError, IOError, ValueError):
+            # not backed by a file descriptor, e.g., io.BytesIO
+            fileno = None
+
+        # reading stops here, instead of at the short read past the end
+        if fileno is not None:
+            self._file_size = os.fstat(fileno).st_size
+        else:
+            f.seek(0, os.SEEK_END)
+            self._file_size = f.tell()
+            f.seek(0)
+
+        self.fh = None
+        if fileno is None:
+            # already in memory, or does its own buffering
+            self.fh = f
+        elif kwargs.get('mmap', True):
+            try:
+                # the mapping is file-like (read, seek, tell, close), and
+                # reading from it is a plain memory copy without going through
+                # the buffered I/O layer.
+                self.fh = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+                f.close()
+            except (ValueError, EnvironmentError):
+                # empty file, or something that can not be mapped
+                pass
+        if self.fh is None:
+            f.seek(0)
+            self.fh = io.BufferedReader(
+                f, buffer_size=kwargs.get('buffer_size', READ_BUFFER_SIZE))
         self.counter = 1
 
         self.pkt_queue = collections.deque()
+        # queued packets that have a source address, indexed by source and in
+        # queue order, so that looking ahead for the next packet from the same
+        # station does not need to scan the whole queue.
+        self._src_index = collections.defaultdict(collections.deque)
         self.has_phy_info = False
 
         self.fix_timestamp = kwargs.get('fix_timestamp', False)
+        self.infer_acked = kwargs.get('infer_acked', True)
+        self.infer_retry = kwargs.get('infer_retry', True)
+        self.fetch_size = kwargs.get('fetch_size', FETCH_SIZE)
+        threshold = self.REFILL_THRESHOLD
+        if threshold is None:
+            threshold = self.fetch_size // 8
+        self._refill_threshold = max(threshold, 2)
 
     def __iter__(self):
         return self
 
-    def __next__(self):
-        return self.next()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release the trace file.
+
+        This happens by itself once the whole trace is read. Packets that are
+        already queued can still be iterated after closing.
+        """
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
 
-    @abc.abstractmethod
     def _next(self, n=100):
         """Get next n packets.
 
@@ -137,67 +303,80 @@ class WlTrace(object):
         Returns:
           list: a list of :class:`pyparser.capture.dot11.Dot11Packet` object.
         """
-        pass
+        raise NotImplementedError()
 
     def _fetch(self):
-        if len(self.pkt_queue) < 2:
-            pkts = self._next(1024)
-            self.pkt_queue.extend(pkts)
+        """Refill the queue if it runs low.
+
+        Returns:
+            bool: ``True`` if there are packets left in the queue.
+        """
+        pkt_queue = self.pkt_queue
+        if len(pkt_queue) < self._refill_threshold:
+            pkts = self._next(self.fetch_size)
+            pkt_queue.extend(pkts)
+            if self.infer_acked or self.infer_retry:
+                for p in pkts:
+                    src = p.src
+                    if src is not None:
+                        self._src_index[src].append(p)
+        return len(pkt_queue) > 0
+
+    def _popleft(self):
+        pkt = self.pkt_queue.popleft()
+        same_src = self._src_index.get(pkt.src)
+        if same_src:
+            same_src.popleft()
+            if len(same_src) == 0:
+                del self._src_index[pkt.src]
+        return pkt
 
     def _infer_acked(self, pkt):
-        # first assume this pkt is not acked
+        # only called for non-multicast mgmt or data packet, first assume
+        # this pkt is not acked
         pkt.acked = False
         pkt.ack_pkt = None
 
-        # infer ``acked`` for non-multicast mgmt or data packet
-        if (pkt.type == dot11.DOT11_TYPE_MANAGEMENT or
-            pkt.type == dot11.DOT11_TYPE_DATA) and\
-                not dot11.is_broadcast(pkt.dest):
-
-            # looking for its ack packet
-            if len(self.pkt_queue) > 0:
-                next_pkt = self.pkt_queue[0]
-                if dot11.is_ack(next_pkt)\
-                        and next_pkt.dest == pkt.src and\
-                        next_pkt.epoch_ts - pkt.end_epoch_ts < 1e-4:
+        # looking for its ack packet
+        if len(self.pkt_queue) > 0:
+            next_pkt = self.pkt_queue[0]
+            if dot11.is_ack(next_pkt) and next_pkt.dest == pkt.src:
+                if pkt.end_epoch_ts is None:
+                    # no way to tell if the ack belongs to this packet
+                    return
+                if next_pkt.epoch_ts - pkt.end_epoch_ts < 1e-4:
                     pkt.acked = True
                     pkt.ack_pkt = next_pkt
                     return
 
-            # if ack packet is not present, look for the next packet from the
-            # same station
-            next_pkt = None
-            for p in self.pkt_queue:
-                if hasattr(p, 'addr2') and p.src == pkt.src:
-                    next_pkt = p
-                    break
-            if next_pkt is not None and next_pkt.seq_num != pkt.seq_num:
-                # the station moves on to next packet, hinting that
-                # current packet was probably acked and the sniffer just
-                # missed the ack packet
-                pkt.acked = True
-
-    def _infer_retry(self, pkt):
-        if hasattr(pkt, 'retry_count'):
-            return
-
+        # if ack packet is not present, look for the next packet from the
+        # same station
+        same_src = self._src_index.get(pkt.src)
+        next_pkt = same_src[0] if same_src else None
+        if next_pkt is not None and next_pkt.seq_num != pkt.seq_num:
+            # the station moves on to next packet, hinting that current
+            # packet was probably acked and the sniffer just missed the ack
+            # packet
+            pkt.acked = True
+
+    def _infer_retry(self, pkt, unicast):
         if not pkt.retry:
-            # this is the first transmission
+            # this is the first transmission. Only retries are counted ahead
+            # below, so there is no earlier ``retry_count`` to look for.
             pkt.retry_count = 0
+        elif hasattr(pkt, 'retry_count'):
+            return
         else:
             # sniffer missed the first transmission, assume this is the first
             # retry
             pkt.retry_count = 1
         current_retry = pkt.retry_count + 1
-        if pkt.type in [dot11.DOT11_TYPE_MANAGEMENT, dot11.DOT11_TYPE_DATA] and\
-                not dot11.is_broadcast(pkt.dest):
-            for p in self.pkt_queue:
-                if hasattr(p, 'addr2') and p.src == pkt.src and\
-                        hasattr(p, 'seq_num'):
-                    if not p.retry or p.seq_num != pkt.seq_num:
-                        break
-                    p.retry_count = current_retry
-                    current_retry += 1
+        if unicast:
+            for p in self._src_index.get(pkt.src, ()):
+                if not p.retry or p.seq_num != pkt.seq_num:
+                    break
+                p.retry_count = current_retry
+                current_retry += 1
 
     def next(self):
         """Iteration function.
@@ -206,28 +385,65 @@ class WlTrace(object):
         can detect if the sniffer missed the previous packet.
         """
 
-        try:
-            self._fetch()
-            pkt = self.pkt_queue.popleft()
-            try:
-                self._infer_acked(pkt)
-            except:
-                pass
-            try:
-                self._infer_retry(pkt)
-            except:
-                pass
-
-            return pkt
-        except IndexError:
+        if not self._fetch():
             raise StopIteration()
+        pkt = self._popleft()
+
+        if self.infer_acked or self.infer_retry:
+            # both only apply to mgmt or data packets sent to one station
+            unicast = pkt.type in _INFERABLE_TYPES and\
+                not dot11.is_broadcast(pkt.dest)
+            if self.infer_acked:
+                if unicast:
+                    self._infer_acked(pkt)
+                else:
+                    # nothing acks a broadcast or control packet
+                    pkt.acked = False
+                    pkt.ack_pkt = None
+            if self.infer_retry:
+                self._infer_retry(pkt, unicast)
+        return pkt
+
+    __next__ = next
 
     def peek(self):
         """Get the current packet without consuming it.
         """
-        try:
-            self._fetch()
-            pkt = self.pkt_queue[0]
-            return pkt
-        except IndexError:
+        if not self._fetch():
             raise StopIteration()
+        return self.pkt_queue[0]
+
+    def iter_batches(self, n=1024):
+        """Iterate over the rest of the trace in batches, with the packets'
+        main fields gathered into NumPy arrays (see :data:`BATCH_FIELDS`).
+
+        Missing fields, e.g., ``retry_count`` when ``infer_retry`` is off, are
+        filled with the field's missing value. Note that the arrays are reused
+        for every batch, copy them if they are needed past the next one.
+
+        Args:
+            n (int): number of packets per batch.
+
+        Yields:
+            tuple: a dict from field to array, and the list of packets. Both
+            are of the same length, at most ``n``.
+        """
+        # only needed here, keep it out of the import of the parsers
+        import numpy as np
+
+        arrays = dict((field, np.empty(n, dtype=dtype))
+                      for field, dtype, _ in BATCH_FIELDS)
+        while True:
+            pkts = list(itertools.islice(self, n))
+            if not pkts:
+                return
+
+            count = len(pkts)
+            fields = {}
+            for field, _, missing in BATCH_FIELDS:
+                vals = [getattr(p, field, missing) for p in pkts]
+                if missing is not None:
+                    vals = [missing if v is None else v for v in vals]
+                fields[field] = arrays[field][:count]
+                fields[field][:] = vals
+            yield fields, pkts
@@ -3,9 +3,7 @@
 
 import struct
 import datetime
-import math
 import binascii
-import hashlib
 
 from common import GenericHeader, PhyInfo
 import utils
@@ -47,6 +45,21 @@ MAX_ACK_LATENCY_US = 100
 
 SEQ_NUM_MODULO = 4096
 
+BROADCAST_MAC = 'ff:ff:ff:ff:ff:ff'
+
+# raw address bytes -> MAC string, dropped wholesale once it grows this big
+_MAC_CACHE = {}
+_MAC_CACHE_SIZE = 65536
+
+
+def _cache_mac(addr):
+    """Format raw address bytes into ``_MAC_CACHE``, on a cache miss.
+    """
+    if len(_MAC_CACHE) >= _MAC_CACHE_SIZE:
+        _MAC_CACHE.clear()
+    mac = _MAC_CACHE[addr] = utils.bin_to_mac(addr)
+    return mac
+
 MGMT_SUBTYPE_NAMES = {
     0: 'Assoc Req',
     1: 'Assoc Resp',
@@ -137,6 +150,22 @@ DOT11A_RATES = [
     54
 ]
 
+_BANDWIDTHS = [20, 40, 80, 160]
+
+# (mcs, bw, long_gi) -> rate, flattened from MCS_TABLE
+_MCS_RATE = dict(((mcs, bw, long_gi), rates[i*2 + (0 if long_gi else 1)])
+                 for mcs, rates in MCS_TABLE.items()
+                 for i, bw in enumerate(_BANDWIDTHS)
+                 for long_gi in [True, False])
+
+# (rate, bw, long_gi) -> mcs. Several MCS share a rate, lowest index wins.
+_RATE_MCS = {}
+for (_mcs, _bw, _long_gi), _rate in sorted(_MCS_RATE.items()):
+    _RATE_MCS.setdefault((_rate, _bw, _long_gi), _mcs)
+del _mcs, _bw, _long_gi, _rate
+
+_DOT11A_MCS = dict((r, idx) for idx, r in enumerate(DOT11A_RATES))
+
 
 def mcs_to_rate(mcs, bw=20, long_gi=True):
     """Convert MCS index to rate in Mbps.
@@ -164,16 +193,13 @@ def mcs_to_rate(mcs, bw=20, long_gi=True):
     >>> mcs_to_rate(13, bw=160, long_gi=True)
     936
     """
-    if bw not in [20, 40, 80, 160]:
-        raise Exception("Unknown bandwidth: %d MHz" % (bw))
-    if mcs not in MCS_TABLE:
+    try:
+        return _MCS_RATE[(mcs, bw, bool(long_gi))]
+    except KeyError:
+        if bw not in _BANDWIDTHS:
+            raise Exception("Unknown bandwidth: %d MHz" % (bw))
         raise Exception("Unknown MCS: %d" % (mcs))
 
-    idx = int((math.log(bw/10, 2)-1)*2)
-    if not long_gi:
-        idx += 1
-    return MCS_TABLE[mcs][idx]
-
 
 def rate_to_mcs(rate, bw=20, long_gi=True):
     """Convert bit rate to MCS index.
@@ -189,20 +215,21 @@ def rate_to_mcs(rate, bw=20, long_gi=True):
     >>> rate_to_mcs(120, bw=40, long_gi=False)
     5
     """
-    if bw not in [20, 40, 80, 160]:
+    if bw not in _BANDWIDTHS:
         raise Exception("Unknown bandwidth: %d MHz" % (bw))
-    idx = int((math.log(bw/10, 2)-1)*2)
-    if not long_gi:
-        idx += 1
 
-    for mcs, rates in MCS_TABLE.items():
-        if abs(rates[idx] - rate) < 1e-3:
+    # all table rates have at most one decimal, so rounding to two decimals
+    # recovers the table key of any rate within tolerance
+    key = round(rate, 2)
+    if abs(key - rate) < 1e-3:
+        mcs = _RATE_MCS.get((key, bw, bool(long_gi)))
+        if mcs is not None:
             return mcs
 
-    # failed. Try dot11a rates
-    for idx, r in enumerate(DOT11A_RATES):
-        if abs(r-rate) < 1e-3:
-            return idx
+        # failed. Try dot11a rates
+        mcs = _DOT11A_MCS.get(key)
+        if mcs is not None:
+            return mcs
 
     raise Exception("MCS not found: rate=%f, bw=%d, long_gi=%s" %
                     (rate, bw, long_gi))
@@ -216,8 +243,17 @@ def is_broadcast(mac):
           insensitive.
     Returns:
         bool.
+
+    >>> is_broadcast('FF:ff:FF:ff:FF:ff')
+    True
+
+    >>> is_broadcast('62:45:b0:fd:d3:ba')
+    False
     """
-    return mac.lower() == 'ff:ff:ff:ff:ff:ff'
+    # MACs parsed by this package are already in lower case, and a unicast MAC
+    # can be ruled out without lowering it most of the time.
+    return mac == BROADCAST_MAC or\
+        (mac[:1] in 'fF' and mac.lower() == BROADCAST_MAC)
 
 
 def is_multicast(mac):
@@ -319,15 +355,30 @@ def next_seq(seq):
     return (seq + 1) % SEQ_NUM_MODULO
 
 
+# fixed layouts decoded for every packet
+_MAC_HEADER = struct.Struct('<HH6s6s6sH')
+_HT_CONTROL = struct.Struct('<I')
+_ADDR4 = struct.Struct('<6s')
+_QOS_CONTROL = struct.Struct('<H')
+_BA_ADDR2_CONTROL = struct.Struct('<6sH')
+_BA_SEQ_BITMAP = struct.Struct('<HQ')
+_BEACON_FIXED = struct.Struct('<QHH')
+_TAG_HEADER = struct.Struct('<BB')
+
+
 class Beacon(object):
     """Payload for 802.11 Beacon packet.
     """
 
-    def __init__(self, pkt):
-        self.timestamp, self.interval, self.capabilities = pkt.unpack('<QHH')
-        tag, len = pkt.unpack('<BB')
+    def __init__(self, pkt, offset):
+        payload = pkt.payload
+        self.timestamp, self.interval, self.capabilities = \
+            _BEACON_FIXED.unpack_from(payload, offset)
+        offset += _BEACON_FIXED.size
+        tag, len = _TAG_HEADER.unpack_from(payload, offset)
+        offset += _TAG_HEADER.size
         if tag == 0:
-            self.ssid, = pkt.unpack('<%ds' % (len))
+            (self.ssid, ), offset = pkt.unpack('<%ds' % (len), offset)
 
 
 class Dot11Packet(GenericHeader):
@@ -338,7 +389,7 @@ class Dot11Packet(GenericHeader):
 
     Args:
         fh (file object): the file's read pointer points to the beginning of a
-          802.11 packet.
+          802.11 packet. Can also be a string holding exactly the packet.
         phy (:class:`pyparser.capture.common.PhyInfo`): PHY information.
         counter (int): packet index in trace file, starting from 1.
     """
@@ -350,34 +401,54 @@ class Dot11Packet(GenericHeader):
         'addr1'
     ]
 
-    def parse_mgmt(self):
-        self.addr2, self.addr3, self.seq = self.unpack('<6s6sH')
+    __slots__ = tuple(FIELDS) + (
+        'real', 'phy', 'counter', 'raw', '_crc_ok',
+        'type', 'subtype', 'to_ds', 'from_ds', 'more_frag', 'retry',
+        'power', 'more_data', 'protected', 'order',
+        'addr2', 'addr3', 'addr4', 'seq_num', 'frag_num',
+        'ht', 'qos', 'beacon',
+        'ba_tid', 'ba_compressed', 'ba_multi_tid', 'ba_policy', 'ba_bitmap',
+        'ba_begin_seq', 'ba_begin_frag',
+        'acked', 'ack_pkt', 'retry_count',
+        '__dict__',
+    )
+    """Everything the parser and the trace inference may set. ``__dict__`` is
+    kept so that users can still attach their own attributes.
+    """
+
+    def parse_mgmt(self, offset):
         if self.order:
-            self.ht, = self.unpack('<I')
+            self.ht, = _HT_CONTROL.unpack_from(self.payload, offset)
+            offset += _HT_CONTROL.size
 
         if self.subtype == DOT11_SUBTYPE_BEACON:
             try:
-                self.beacon = Beacon(self)
-            except:
+                self.beacon = Beacon(self, offset)
+            except struct.error:
                 pass
 
-    def parse_data(self):
-        self.addr2, self.addr3, self.seq = self.unpack('<6s6sH')
+    def parse_data(self, offset):
         if self.from_ds and self.to_ds:
-            self.addr4, = self.unpack('<6s')
+            addr4, = _ADDR4.unpack_from(self.payload, offset)
+            offset += _ADDR4.size
+            self.addr4 = _MAC_CACHE.get(addr4) or _cache_mac(addr4)
         if self.subtype >= 8:
-            self.qos, = self.unpack('<H')
+            self.qos, = _QOS_CONTROL.unpack_from(self.payload, offset)
 
-    def parse_control(self):
+    def parse_control(self, offset):
         if self.subtype == DOT11_SUBTYPE_BLOCK_ACK:
-            self.addr2, ba_control = self.unpack('<6sH')
+            addr2, ba_control = _BA_ADDR2_CONTROL.unpack_from(
+                self.payload, offset)
+            offset += _BA_ADDR2_CONTROL.size
+            self.addr2 = _MAC_CACHE.get(addr2) or _cache_mac(addr2)
             self.ba_tid = ba_control >> 12
             self.ba_compressed = ba_control & 0x0004 > 0
             self.ba_multi_tid = ba_control & 0x0002 > 0
             self.ba_policy = ba_control & 0x0001 > 0
 
             if not self.ba_multi_tid and self.ba_compressed:
-                ba_seq_control, self.ba_bitmap = self.unpack('<HQ')
+                ba_seq_control, self.ba_bitmap = _BA_SEQ_BITMAP.unpack_from(
+                    self.payload, offset)
                 self.ba_begin_seq = ba_seq_control >> 4
                 self.ba_begin_frag = ba_seq_control & 0x000f
 
@@ -389,10 +460,26 @@ class Dot11Packet(GenericHeader):
             self.phy = PhyInfo()
             return
 
-        packet_start = fh.tell()
-
-        cls = self.__class__
-        super(cls, self).__init__(fh, *args, **kwargs)
+        # read the whole frame once, it serves as both payload and raw
+        s = utils.get_struct(self.PACK_PATTERN)
+        if isinstance(fh, str):
+            raw = fh
+        else:
+            raw = fh.read()
+            fh.close()
+        self.raw = self.payload = raw
+        # management and data frames start with the full 24-byte header,
+        # decode it in one go whenever the frame is long enough
+        full = len(raw) >= _MAC_HEADER.size
+        if full:
+            self.fc, self.duration, addr1, addr2, addr3, seq =\
+                _MAC_HEADER.unpack_from(raw)
+        elif len(raw) >= s.size:
+            self.fc, self.duration, addr1 = s.unpack_from(raw)
+        else:
+            raise IOError('Short read bytes, excect %d, got %d' %
+                          (s.size, len(raw)))
+        self.addr1 = _MAC_CACHE.get(addr1) or _cache_mac(addr1)
 
         self.real = True
         self.phy = phy
@@ -401,43 +488,37 @@ class Dot11Packet(GenericHeader):
         self.acked = False
         self.ack_pkt = None
 
-        self.type = (self.fc & 0x000c) >> 2
-        self.subtype = (self.fc & 0x00f0) >> 4
-        for shift, flag in enumerate(['to_ds', 'from_ds', 'more_frag', 'retry',
-                                      'power', 'more_data', 'protected',
-                                      'order'], start=8):
-            setattr(self, flag, (self.fc & (1 << shift)) > 0)
-
-        self.payload = fh.read()
-        self.offset = 0
-
+        fc = self.fc
+        self.type = (fc & 0x000c) >> 2
+        self.subtype = (fc & 0x00f0) >> 4
+        self.to_ds = fc & 0x0100 > 0
+        self.from_ds = fc & 0x0200 > 0
+        self.more_frag = fc & 0x0400 > 0
+        self.retry = fc & 0x0800 > 0
+        self.power = fc & 0x1000 > 0
+        self.more_data = fc & 0x2000 > 0
+        self.protected = fc & 0x4000 > 0
+        self.order = fc & 0x8000 > 0
+
+        self.seq_num = None
+        self.frag_num = None
         try:
-            if self.type == DOT11_TYPE_MANAGEMENT:
-                self.parse_mgmt()
-            elif self.type == DOT11_TYPE_DATA:
-                self.parse_data()
-            elif self.type == DOT11_TYPE_CONTROL:
-                self.parse_control()
-        except:
+            if self.type == DOT11_TYPE_CONTROL:
+                self.parse_control(s.size)
+            elif full and (self.type == DOT11_TYPE_MANAGEMENT or
+                           self.type == DOT11_TYPE_DATA):
+                self.addr2 = _MAC_CACHE.get(addr2) or _cache_mac(addr2)
+                self.addr3 = _MAC_CACHE.get(addr3) or _cache_mac(addr3)
+                self.frag_num = seq & 0x000f
+                self.seq_num = (seq & 0xfff0) >> 4
+                if self.type == DOT11_TYPE_MANAGEMENT:
+                    self.parse_mgmt(_MAC_HEADER.size)
+                else:
+                    self.parse_data(_MAC_HEADER.size)
+        except struct.error:
+            # truncated packet, keep whatever has been parsed
             pass
 
-        for attr in ['addr1', 'addr2', 'addr3', 'addr4']:
-            if hasattr(self, attr):
-                setattr(self, attr, utils.bin_to_mac(getattr(self, attr)))
-
-        if hasattr(self, 'seq'):
-            self.frag_num = self.seq & 0x000f
-            self.seq_num = (self.seq & 0xfff0) >> 4
-            del self.seq
-        else:
-            self.seq_num = None
-            self.frag_num = None
-
-        fh.seek(packet_start)
-        self.raw = fh.read()
-        self._hash = None
-
-        fh.close()
         self._crc_ok = None
 
     @property
@@ -480,14 +561,18 @@ class Dot11Packet(GenericHeader):
 
     @property
     def hash(self):
-        if self._hash is None:
-            self._hash = hashlib.md5(self.raw).hexdigest()
-        return self._hash
+        """Hash (int) of the raw packet bytes.
+
+        This is the interpreter's string hash, which is computed only once per
+        packet. It is meant to match the same packet in traces loaded by the
+        same process, not to be stored.
+        """
+        return hash(self.raw)
 
     def __eq__(self, other):
         if not isinstance(other, Dot11Packet):
             return False
-        return self.hash == other.hash
+        return self.hash == other.hash and self.raw == other.raw
 
     def air_time(self):
         """Duration of the packet in air.
@@ -2,8 +2,9 @@
 
 import argparse
 import datetime
+import heapq
+import itertools
 
-from collections import OrderedDict
 import numpy as np
 
 import progressbar as pbar
@@ -31,6 +32,50 @@ def arg_parser():
     return parser
 
 
+def by_mactime(pkts, tag, mactimes=None):
+    """Decorate packets with a sort key, and sort them for :func:`heapq.merge`.
+
+    Packets without mactime are dropped. The tag and the position break
+    ties, so that merging the results of several slices gives the same order
+    as a stable :func:`sorted` over all of them.
+
+    mactime is not always monotonic within a trace (TSF resets or wraps,
+    rescaling), so the packets are sorted here, which is linear if they are
+    already in order.
+
+    Args:
+        pkts (list): packets.
+        tag (int): which trace the packets come from.
+        mactimes (list): mactime of each packet to use instead of
+          ``p.phy.mactime``, ``None`` if the packet has none.
+    """
+    if mactimes is None:
+        mactimes = [p.phy.mactime for p in pkts]
+    return sorted((m, tag, i, p)
+                  for i, (m, p) in enumerate(itertools.izip(mactimes, pkts))
+                  if m is not None)
+
+
+def beacon_index(trace):
+    """Index beacons that carry mactime by their hash.
+
+    Returns:
+        (dict, list): hash to (last seen) packet, and the hashes in the
+            order they were first seen.
+    """
+    index = {}
+    order = []
+    for p in trace:
+        if p.type == dot11.DOT11_TYPE_MANAGEMENT and\
+                p.subtype == dot11.DOT11_SUBTYPE_BEACON and\
+                p.phy.mactime is not None:
+            h = p.hash
+            if h not in index:
+                order.append(h)
+            index[h] = p
+    return index, order
+
+
 class Aggregator(object):
 
     def __init__(self, trace1, trace2, verbose=False, *args, **kwargs):
@@ -46,11 +91,9 @@ class Aggregator(object):
         if not isinstance(self.trace2, list):
             self.trace2 = list(self.trace2)
 
-        hash1 = OrderedDict((p.hash, p) for p in self.trace1
-                            if dot11.is_beacon(p) and p.phy.mactime is not None)
-        hash2 = OrderedDict((p.hash, p) for p in self.trace2
-                            if dot11.is_beacon(p) and p.phy.mactime is not None)
-        common_hash = [h for h in hash1 if h in hash2]
+        hash1, order1 = beacon_index(self.trace1)
+        hash2, _ = beacon_index(self.trace2)
+        common_hash = [h for h in order1 if h in hash2]
 
         if self.verbose:
             logger.debug("Beacons:: Trace1: %d, Trace2: %d, Common: %d" %
@@ -69,40 +112,54 @@ class Aggregator(object):
             progress = 0
             bar.start()
 
-        for first_beacon, second_beacon in utils.pairwise(common_hash):
-            t1_a, t2_a = hash1[first_beacon].phy.mactime, hash1[
-                second_beacon].phy.mactime
-            t1_b, t2_b = hash2[first_beacon].phy.mactime, hash2[
-                second_beacon].phy.mactime
+        # trace2's mactimes are rescaled as an array, and only written back
+        # to the packets once all intervals are done
+        has_mactime2 = np.fromiter((p.phy.mactime is not None
+                                    for p in self.trace2),
+                                   dtype=bool, count=len(self.trace2))
+        mactime2 = np.fromiter((p.phy.mactime or 0 for p in self.trace2),
+                               dtype=np.int64, count=len(self.trace2))
+
+        beacons = [(hash1[h], hash2[h]) for h in common_hash]
+        for (first_a, first_b), (second_a, second_b) in\
+                utils.pairwise(beacons):
+            t1_a, t2_a = first_a.phy.mactime, second_a.phy.mactime
+            t1_b, t2_b = first_b.phy.mactime, second_b.phy.mactime
             duration = t2_a - t1_a
             ratio = float(duration) / (t2_b - t1_b)
             drift = (t2_b - t1_b) - (t2_a - t1_a)
             self.drifts.append((duration, drift))
 
-            for p in self.trace2[hash2[first_beacon].counter:
-                                 (hash2[second_beacon].counter - 1)]:
-                if p.phy.mactime is not None:
-                    p.phy.mactime = int(ratio * (p.phy.mactime - t1_b) + t1_a)
-
-            self.merged_trace.append(hash1[first_beacon])
-            for pkt in sorted(
-                    self.trace1[hash1[first_beacon].counter:
-                                (hash1[second_beacon].counter - 1)] +
-                    self.trace2[hash2[first_beacon].counter:(
-                        hash2[second_beacon].counter - 1)],
-                    key=lambda p: p.phy.mactime):
-                if pkt.phy.mactime is None:
-                    continue
-                if (pkt.phy.mactime - self.merged_trace[-1].phy.mactime) < 5\
-                        and pkt.hash == self.merged_trace[-1].hash:
+            lo, hi = first_b.counter, second_b.counter - 1
+            seg = mactime2[lo:hi]
+            seg[:] = (ratio * (seg - t1_b) + t1_a).astype(np.int64)
+            seg = seg.astype(object)
+            seg[~has_mactime2[lo:hi]] = None
+
+            self.merged_trace.append(first_a)
+            last_mactime = t1_a
+            # both slices are sorted by mactime by by_mactime
+            for mactime, _, _, pkt in heapq.merge(
+                    by_mactime(self.trace1[first_a.counter:
+                                           (second_a.counter - 1)], 0),
+                    by_mactime(self.trace2[lo:hi], 1, seg.tolist())):
+                # comparing raw directly bails out on length or first byte
+                # mismatch, and never needs a digest
+                if (mactime - last_mactime) < 5\
+                        and pkt.raw == self.merged_trace[-1].raw:
                     continue
                 self.merged_trace.append(pkt)
+                last_mactime = mactime
 
             if self.verbose:
                 bar.update(progress)
                 progress += 1
 
         self.merged_trace.append(hash1[common_hash[-1]])
+        for p, mactime, has_mactime in itertools.izip(
+                self.trace2, mactime2.tolist(), has_mactime2):
+            if has_mactime:
+                p.phy.mactime = mactime
         if self.verbose:
             bar.finish()
             intervals = [t[0] for t in self.drifts]
@@ -1,8 +1,8 @@
 """Pcap file parser.
 """
 
+import io
 import struct
-import binascii
 try:
     from cStringIO import StringIO
 except:
@@ -10,6 +10,7 @@ except:
 
 import radiotap
 import dot11
+import utils
 
 from common import WlTrace, GenericHeader, PhyInfo
 
@@ -27,6 +28,8 @@ PCAP_FILE_MAGIC_LE_NS = struct.pack('<I', _PCAP_FILE_MAGIC_NUMBER_NS)
 PCAP_FILE_MAGIC_BE = struct.pack('>I', _PCAP_FILE_MAGIC_NUMBER)
 PCAP_FILE_MAGIC_BE_NS = struct.pack('>I', _PCAP_FILE_MAGIC_NUMBER_NS)
 
+WRITE_BUFFER_SIZE = 1024 * 1024
+
 
 class PcapException(Exception):
     pass
@@ -63,7 +66,7 @@ class PcapHeader(GenericHeader):
 
         if magic not in [PCAP_FILE_MAGIC_LE, PCAP_FILE_MAGIC_LE_NS,
                          PCAP_FILE_MAGIC_BE, PCAP_FILE_MAGIC_BE_NS]:
-            raise Exception("Unknown file magic: %s" % (binascii(magic)))
+            raise Exception("Unknown file magic: %s" % (magic.encode('hex')))
 
         self.endian = '<' if magic in [PCAP_FILE_MAGIC_LE,
                                        PCAP_FILE_MAGIC_LE_NS] else '>'
@@ -81,10 +84,9 @@ class PcapHeader(GenericHeader):
     @classmethod
     def to_binary(cls, endian='@', snaplen=65535,
                   network=_LINKTYPE_IEEE802_11_RADIOTAP):
-        pattern = '%s%s' % (endian, cls._PACK_PATTERN_BASE)
-        return struct.pack(pattern, _PCAP_FILE_MAGIC_NUMBER,
-                           _PCAP_VERSION_MAJOR,
-                           _PCAP_VERSION_MINOR, 0, 0, snaplen, network)
+        s = utils.get_struct(endian + cls._PACK_PATTERN_BASE)
+        return s.pack(_PCAP_FILE_MAGIC_NUMBER, _PCAP_VERSION_MAJOR,
+                      _PCAP_VERSION_MINOR, 0, 0, snaplen, network)
 
 
 class PcapPacketHeader(GenericHeader):
@@ -98,6 +100,7 @@ class PcapPacketHeader(GenericHeader):
         'incl_len',
         'orig_len',
     ]
+    __slots__ = tuple(FIELDS) + ('epoch_ts',)
 
     def __init__(self, fh, header, *args, **kwargs):
         cls = self.__class__
@@ -110,14 +113,14 @@ class PcapPacketHeader(GenericHeader):
 
     @classmethod
     def encapsulate(cls, pkt, endian='@'):
-        pattern = '%s%s' % (endian, cls._PACK_PATTERN_BASE)
+        s = utils.get_struct(endian + cls._PACK_PATTERN_BASE)
         ts_sec = int(pkt.epoch_ts)
         ts_usec = int((pkt.epoch_ts - ts_sec) * 1e6)
         phy = pkt.phy.to_binary()
         incl_len = len(phy) + pkt.phy.caplen
         orig_len = len(phy) + pkt.phy.len
-        return '%s%s%s' % (struct.pack(pattern, ts_sec, ts_usec, incl_len,
-                                       orig_len), phy, pkt.raw)
+        return ''.join((s.pack(ts_sec, ts_usec, incl_len, orig_len), phy,
+                        pkt.raw))
 
 
 class PcapCapture(WlTrace):
@@ -142,43 +145,57 @@ class PcapCapture(WlTrace):
         if self.header.network == _LINKTYPE_IEEE802_11_RADIOTAP:
             self.has_phy_info = True
 
+        # per packet header is decoded in place with one compiled struct, see
+        # PcapPacketHeader for the layout.
+        self._pkt_header = utils.get_struct('%s%s' % (
+            self.header.endian, PcapPacketHeader._PACK_PATTERN_BASE))
+        self._ts_div = 1e9 if self.header.nano_ts else 1e6
+
     @classmethod
     def save(cls, path, pkts):
-        with open(path, 'wb') as f:
+        # one packet is only a few hundred bytes, let the writer batch them
+        with io.open(path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
             f.write(PcapHeader.to_binary())
             for pkt in pkts:
                 f.write(PcapPacketHeader.encapsulate(pkt))
 
     def _read_one_pkt(self):
-        pkt_header = PcapPacketHeader(self.fh, self.header)
-        if pkt_header.incl_len > self.header.snaplen:
+        raw = self.fh.read(self._pkt_header.size)
+        if len(raw) != self._pkt_header.size:
+            raise IOError("Short read: expect %d, got %d" %
+                          (self._pkt_header.size, len(raw)))
+        ts_sec, ts_usec, incl_len, orig_len = self._pkt_header.unpack(raw)
+
+        if incl_len > self.header.snaplen:
             raise PcapException("snaplen: %d, incl_len: %d" %
-                                (self.header.snaplen, pkt_header.incl_len))
+                                (self.header.snaplen, incl_len))
 
-        raw = self.fh.read(pkt_header.incl_len)
-        if len(raw) != pkt_header.incl_len:
+        raw = self.fh.read(incl_len)
+        if len(raw) != incl_len:
             raise IOError("Short read: expect %d, got %d" %
-                          (pkt_header.incl_len, len(raw)))
+                          (incl_len, len(raw)))
 
-        pkt_fh = StringIO(raw)
         if self.header.network == _LINKTYPE_IEEE802_11_RADIOTAP:
+            pkt_fh = StringIO(raw)
             rh = radiotap.RadiotapHeader(pkt_fh)
             phy = rh.to_phy()
-            phy.len = pkt_header.orig_len - rh._it_len
-            phy.caplen = pkt_header.incl_len - rh._it_len
+            phy.len = orig_len - rh._it_len
+            phy.caplen = incl_len - rh._it_len
         else:
-            phy = PhyInfo(has_fcs=False, len=pkt_header.orig_len)
-            phy.caplen = pkt_header.incl_len
-
-        phy.epoch_ts = pkt_header.epoch_ts
-        if self.fix_timestamp and phy.rate is not None:
-            phy.epoch_ts -= phy.len * 8 / phy.rate * 1e-6
+            # nothing in front of the 802.11 frame, no need for a reader
+            pkt_fh = raw
+            phy = PhyInfo(has_fcs=False, len=orig_len)
+            phy.caplen = incl_len
+
+        phy.epoch_ts = ts_sec + ts_usec / self._ts_div + self.header.thiszone
+        if phy.rate:
+            # same as Dot11Packet.air_time, worked out once for both
+            air_time = phy.len * 8 / phy.rate * 1e-6
+            if self.fix_timestamp:
+                phy.epoch_ts -= air_time
+            phy.end_epoch_ts = phy.epoch_ts + air_time
 
         pkt = dot11.Dot11Packet(pkt_fh, phy=phy, counter=self.counter)
-        try:
-            phy.end_epoch_ts = phy.epoch_ts + pkt.air_time()
-        except:
-            pass
         self.counter += 1
         return pkt
 
@@ -188,18 +205,21 @@ class PcapCapture(WlTrace):
 
         pkts = []
         for _ in xrange(n):
+            if self.fh.tell() >= self._file_size:
+                self.close()
+                break
             try:
                 pkt = self._read_one_pkt()
                 if pkt.phy.ampdu_ref is not None:
                     # read all packets in this ampdu
                     ampdu_ref = pkt.phy.ampdu_ref
+                    ampdu_start = len(pkts)
                     while pkt.phy.ampdu_ref == ampdu_ref:
                         if pkt.phy.last_frame:
                             # update previous ampdu's rate info
-                            for p in reversed(pkts):
-                                if p.phy.ampdu_ref != ampdu_ref:
-                                    break
-                                p.phy.rate = pkt.phy.rate
+                            rate = pkt.phy.rate
+                            for p in pkts[ampdu_start:]:
+                                p.phy.rate = rate
                             break
                         pkts.append(pkt)
                         pkt = self._read_one_pkt()
@@ -207,8 +227,7 @@ class PcapCapture(WlTrace):
                 pkts.append(pkt)
 
             except IOError:
-                self.fh.close()
-                self.fh = None
+                self.close()
                 break
 
         return pkts
@@ -11,13 +11,9 @@ payloads. The format is documented here:
 http://varsanofiev.com/inside/airopeekv9.htm
 
 """
+import os
+import operator
 import struct
-import datetime
-
-try:
-    from cStringIO import StringIO
-except:
-    from StringIO import StringIO
 
 import dot11
 import xml.etree.ElementTree as ET
@@ -54,6 +50,7 @@ class PeektaggedSectionHeader(GenericHeader):
         'len',
         'pad',
     ]
+    __slots__ = tuple(FIELDS)
 
     def __init__(self, fh, *args, **kwargs):
         cls = self.__class__
@@ -83,24 +80,84 @@ class PeektaggedPacketHeader(object):
         0xffff: ('caplen', '<I'),
     }
 
-    def __init__(self, fh, *args, **kwargs):
-        cls = self.__class__
-        super(cls, self).__init__(*args, **kwargs)
+    # tags that are absent from a header are left unset, see ``to_phy``
+    __slots__ = tuple(attr for attr, _ in TAGS.values()) + (
+        'mcs', 'epoch_ts', 'end_epoch_ts', 'fcs_error')
 
-        while True:
-            tag_raw = fh.read(2)
-            val_raw = fh.read(4)
-            if len(tag_raw) != 2 or len(val_raw) != 4:
-                raise IOError("Short read.")
+    _TLV_SIZE = struct.calcsize('<HI')
+
+    READ_SIZE = 256
+    """How many bytes to read at once while looking for the last tag. The
+    file is rewound to right after the last tag once it is found.
+    """
+
+    _DECODE_PLANS = {}
+    """Tag sequence -> (attributes, value getter, signed attributes), built
+    the first time a header layout is seen.
+    """
+
+    @classmethod
+    def _decode_plan(cls, tags):
+        """Work out where the known tags' values are in the flat list of
+        unpacked (tag, value) pairs.
 
-            tag, = struct.unpack('<H', tag_raw)
+        Headers in a trace almost always carry the same tags in the same
+        order, so this only runs a handful of times per trace.
+        """
+        plan = cls._DECODE_PLANS.get(tags)
+        if plan is not None:
+            return plan
+
+        attrs = []
+        indexes = []
+        signed = []
+        for i, tag in enumerate(tags):
             if tag not in cls.TAGS:
                 continue
             attr, fmt = cls.TAGS[tag]
-            setattr(self, attr, struct.unpack(fmt, val_raw)[0])
+            attrs.append(attr)
+            indexes.append(2 * i + 1)
+            if fmt == '<i' and attr not in signed:
+                # a repeated tag is still converted only once
+                signed.append(attr)
+
+        if len(indexes) == 1:
+            # itemgetter returns a bare value for a single index
+            def getter(vals, i=indexes[0]):
+                return (vals[i], )
+        else:
+            getter = operator.itemgetter(*indexes)
+        plan = cls._DECODE_PLANS[tags] = (attrs, getter, signed)
+        return plan
 
-            if tag == 0xffff:
+    def __init__(self, fh, *args, **kwargs):
+        cls = self.__class__
+        super(cls, self).__init__(*args, **kwargs)
+
+        # unpack everything read so far as (tag, value) pairs in one go, and
+        # look for the last tag among them
+        buf = fh.read(cls.READ_SIZE)
+        while True:
+            count = len(buf) // cls._TLV_SIZE
+            vals = utils.get_struct('<' + 'HI' * count).unpack_from(buf)
+            tags = vals[0::2]
+            try:
+                count = tags.index(0xffff) + 1
                 break
+            except ValueError:
+                more = fh.read(cls.READ_SIZE)
+                if not more:
+                    raise IOError("Short read.")
+                buf += more
+        fh.seek(count * cls._TLV_SIZE - len(buf), os.SEEK_CUR)
+
+        attrs, getter, signed = cls._decode_plan(tags[:count])
+        for attr, val in zip(attrs, getter(vals)):
+            setattr(self, attr, val)
+        for attr in signed:
+            val = getattr(self, attr)
+            if val & 0x80000000:
+                setattr(self, attr, val - 0x100000000)
 
         if hasattr(self, 'ext_flags') and\
                 self.ext_flags & EXT_FLAGS_MCS_INDEX_USED:
@@ -174,6 +231,9 @@ class PeektaggedCapture(WlTrace):
 
         pkts = []
         for unused in xrange(n):
+            if self.fh.tell() >= self._file_size:
+                self.close()
+                break
             try:
                 peektagged_header = PeektaggedPacketHeader(self.fh)
 
@@ -181,14 +241,13 @@ class PeektaggedCapture(WlTrace):
                 if len(pkt_raw) != peektagged_header.caplen:
                     break
 
-                pkt = dot11.Dot11Packet(StringIO(
-                    pkt_raw), phy=peektagged_header.to_phy(),
+                pkt = dot11.Dot11Packet(
+                    pkt_raw, phy=peektagged_header.to_phy(),
                     counter=self.counter)
                 self.counter += 1
                 pkts.append(pkt)
             except IOError:
-                self.fh.close()
-                self.fh = None
+                self.close()
                 break
 
         return pkts
@@ -55,6 +55,7 @@ class RadiotapHeader(common.GenericHeader):
     PACK_PATTERN = '<BBHI'
     """Radiotap header is always in little endian.
     """
+    _HEADER_SIZE = struct.calcsize(PACK_PATTERN)
     FIELDS = [
         '_it_version',
         '_it_pad',
@@ -83,6 +84,53 @@ class RadiotapHeader(common.GenericHeader):
         (20, 'IHxx', '_ampdu', 4),
     ]
 
+    _PRESENT_FIELDS = dict((1 << idx, (utils.get_struct('<%s' % (fmt)), field,
+                                       align))
+                           for idx, fmt, field, align in PRESENT_FLAGS)
+    """Present bit -> (compiled format, field, align), for all the
+    ``PRESENT_FLAGS`` we know how to decode.
+    """
+
+    _PRESENT_MASK = sum(1 << idx for idx, _, _, _ in PRESENT_FLAGS)
+
+    _ABSENT_FIELDS = dict((field, None) for _, _, field, _ in PRESENT_FLAGS)
+
+    _DECODE_PLANS = {}
+    """(present bits, start offset) -> (compiled format, [(field, index,
+    count)]), built the first time a header layout is seen.
+    """
+
+    @classmethod
+    def _decode_plan(cls, present, offset):
+        """Compile all present fields into one format, with the alignment
+        padding in between spelled out.
+
+        A trace usually has only a handful of distinct present bitmaps, so
+        this turns the per-field decoding into a single ``unpack_from``.
+        """
+        key = (present, offset)
+        plan = cls._DECODE_PLANS.get(key)
+        if plan is not None:
+            return plan
+
+        fmt = '<'
+        fields = []
+        count = 0
+        # lowest (first in payload) bit first. All alignments are power of 2.
+        while present:
+            bit = present & -present
+            present ^= bit
+            s, field, align = cls._PRESENT_FIELDS[bit]
+            aligned = (offset + align - 1) & ~(align - 1)
+            fmt += 'x' * (aligned - offset) + s.format[1:]
+            n = len(s.unpack('\0' * s.size))
+            fields.append((field, count, n))
+            count += n
+            offset = aligned + s.size
+
+        plan = cls._DECODE_PLANS[key] = (struct.Struct(fmt), fields)
+        return plan
+
     def __init__(self, fh, *args, **kwargs):
         cls = self.__class__
         super(cls, self).__init__(fh, *args, **kwargs)
@@ -91,31 +139,29 @@ class RadiotapHeader(common.GenericHeader):
             raise Exception('Incorrect version: expect %d, got %d' %
                             (cls._it_version, self._it_version))
 
-        rest_len = self._it_len - struct.calcsize(cls.PACK_PATTERN)
+        rest_len = self._it_len - cls._HEADER_SIZE
         rest = fh.read(rest_len)
         if len(rest) != rest_len:
             raise Exception('Short read: expect %d, got %d' %
                             (rest_len, len(rest)))
 
         self.payload = rest
-        self.offset = 0
+        offset = 0
 
         present = self._it_present
         shift = 32
         while (present >> 31) > 0:
-            present, = self.unpack('<I')
+            (present, ), offset = self.unpack('<I', offset)
             self._it_present = (present << shift) + self._it_present
             shift += 32
 
-        for idx, fmt, field, align in cls.PRESENT_FLAGS:
-            if self._it_present & (1 << idx):
-                self.offset = utils.align_up(self.offset, align)
-                val = self.unpack(fmt)
-                if len(val) == 1:
-                    val = val[0]
-                setattr(self, field, val)
-            else:
-                setattr(self, field, None)
+        d = self.__dict__
+        d.update(cls._ABSENT_FIELDS)
+        s, fields = cls._decode_plan(self._it_present & cls._PRESENT_MASK,
+                                     offset)
+        vals = s.unpack_from(rest, offset)
+        for field, i, n in fields:
+            d[field] = vals[i] if n == 1 else vals[i:i + n]
 
         if self._it_present & _PRESENT_FLAG_CHANNEL:
             self.freq_mhz = self._channel & 0x0000ffff
@@ -178,32 +224,39 @@ class RadiotapHeader(common.GenericHeader):
         return header
 
     def to_phy(self):
-        return common.PhyInfo(**self.__dict__)
+        return common.PhyInfo(
+            signal=self.signal, noise=self.noise, freq_mhz=self.freq_mhz,
+            has_fcs=self.has_fcs, fcs_error=self.fcs_error, rate=self.rate,
+            mcs=self.mcs, mactime=self.mactime, ampdu_ref=self.ampdu_ref,
+            last_frame=self.last_frame)
 
     def to_binary(self):
         cls = self.__class__
 
+        # lay out the present fields first, so that the whole header can be
+        # packed into one preallocated buffer
         offset = 0
         present_flag = 0
-        payload = ''
-
+        fields = []
         for idx, fmt, field, align in cls.PRESENT_FLAGS:
-            if getattr(self, field, None) is None:
+            attr = getattr(self, field, None)
+            if attr is None:
                 continue
             present_flag |= (1 << idx)
-            aligned_offset = utils.align_up(offset, align)
-            if aligned_offset != offset:
-                fmt = '%s%s' % ('x' * (aligned_offset - offset), fmt)
+            if type(attr) != tuple:
+                attr = (attr, )
+            s = cls._PRESENT_FIELDS[1 << idx][0]
+            offset = utils.align_up(offset, align)
+            fields.append((s, cls._HEADER_SIZE + offset, field, attr))
+            offset += s.size
+
+        it_len = cls._HEADER_SIZE + offset
+        buf = bytearray(it_len)
+        utils.get_struct(cls.PACK_PATTERN).pack_into(buf, 0, 0, 0, it_len,
+                                                     present_flag)
+        for s, offset, field, attr in fields:
             try:
-                attr = getattr(self, field)
-                if type(attr) != tuple:
-                    attr = (attr, )
-                payload += struct.pack(fmt, *attr)
-            except:
+                s.pack_into(buf, offset, *attr)
+            except (struct.error, TypeError):
                 raise Exception('%s: %s' % (field, getattr(self, field)))
-            offset += struct.calcsize(fmt)
-
-        header = struct.pack(cls.PACK_PATTERN, 0, 0,
-                             struct.calcsize(cls.PACK_PATTERN) + len(payload),
-                             present_flag)
-        return header + payload
+        return str(buf)
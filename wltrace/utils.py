@@ -7,6 +7,11 @@ import binascii
 
 UTC_EPOCH = datetime.datetime(1970, 1, 1)
 
+# seconds per unit of the high 32 bits of a Windows timestamp (in ns), and
+# seconds between 1601-01-01 and 1970-01-01
+_WIN_TS_HIGH_UNIT = (2 ** 32) / 1e9
+_WIN_TS_EPOCH_OFFSET = 11644473600
+
 POLY = [
     1, 0, 0, 0,         # 32 -- 29
     0, 0, 1, 0,         # 28 -- 25
@@ -19,6 +24,36 @@ POLY = [
     1,                  # 0
 ]
 
+_STRUCT_CACHE = {}
+
+# two hex digits of every octet value, and the octets of a MAC address
+_HEX_OCTETS = tuple('%02x' % (i) for i in range(256))
+_MAC_OCTETS = struct.Struct('6B')
+
+
+def get_struct(fmt):
+    """Get the compiled :class:`struct.Struct` object of ``fmt``.
+
+    The compiled object is cached, so that the format string is only parsed
+    once no matter how many times it is used.
+
+    Args:
+        fmt (str): :mod:`struct` format.
+
+    Returns:
+        :class:`struct.Struct`: compiled format.
+
+    >>> get_struct('<HI').size
+    6
+
+    >>> get_struct('<HI') is get_struct('<HI')
+    True
+    """
+    s = _STRUCT_CACHE.get(fmt)
+    if s is None:
+        s = _STRUCT_CACHE[fmt] = struct.Struct(fmt)
+    return s
+
 
 def calc_padding(fmt, align):
     """Calculate how many padding bytes needed for ``fmt`` to be aligned to
@@ -78,7 +113,7 @@ def win_ts_to_unix_epoch(high, low):
     Returns:
         float
     """
-    return high * ((2 ** 32) / 1e9) + low / 1e9 - 11644473600
+    return high * _WIN_TS_HIGH_UNIT + low / 1e9 - _WIN_TS_EPOCH_OFFSET
 
 
 def win_ts(high, low):
@@ -108,10 +143,18 @@ def bin_to_mac(bin, size=6):
 
     Raises:
         Exception: if ``len(bin)`` is not 6.
+
+    >>> bin_to_mac('\\x10\\xfe\\xed\\xe5\\x8c\\x97')
+    '10:fe:ed:e5:8c:97'
     """
     if len(bin) != size:
         raise Exception("Invalid MAC address: %s" % (bin))
-    return ':'.join([binascii.hexlify(o) for o in bin])
+    if size == 6:
+        a, b, c, d, e, f = _MAC_OCTETS.unpack(bin)
+        h = _HEX_OCTETS
+        return ':'.join((h[a], h[b], h[c], h[d], h[e], h[f]))
+    h = binascii.hexlify(bin)
+    return ':'.join([h[i:i + 2] for i in range(0, len(h), 2)])
 
 
 def pairwise(it):
@@ -7,10 +7,8 @@ Radiotap header if exists.
 """
 
 import os
-import binascii
-import abc
 import io
-import collections
+import stat
 
 import pcap
 import peektagged
@@ -32,28 +30,47 @@ FILE_TYPE_HANDLER = {
 """
 
 
-def is_packet_trace(path):
-    """Determine if a file is a packet trace that is supported by this module.
+def get_handler(path):
+    """Find out which handler can load a file, by its magic.
+
+    The result can be passed on to :func:`load_trace`, so that the magic is
+    not read again.
 
     Args:
         path (str): path to the trace file.
 
     Returns:
-        bool: True if the file is a valid packet trace.
+        The handler class, or ``None`` if the file is not a valid packet trace.
     """
-    path = os.path.abspath(path)
-    if not os.path.isfile(path):
-        return False
-
+    # only the magic is needed, skip the buffered file object. Opening does
+    # not block, e.g., on a FIFO, and anything but a regular file is rejected
+    # before reading from it.
     try:
-        f = open(path, 'rb')
-    except:
-        return False
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0))
+    except OSError:
+        return None
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            return None
+        magic = os.read(fd, MAGIC_LEN)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
 
-    magic = f.read(4)
-    f.close()
+    return FILE_TYPE_HANDLER.get(magic)
 
-    return magic in FILE_TYPE_HANDLER
+
+def is_packet_trace(path):
+    """Determine if a file is a packet trace that is supported by this module.
+
+    Args:
+        path (str): path to the trace file.
+
+    Returns:
+        bool: True if the file is a valid packet trace.
+    """
+    return get_handler(path) is not None
 
 
 def load_trace(path, *args, **kwargs):
@@ -65,13 +82,24 @@ def load_trace(path, *args, **kwargs):
 
     Args:
         path (str): the file's path to be loaded.
+        handler: the file's handler, as returned by :func:`get_handler`. If
+            given, the magic is not checked again.
 
     Returns:
         ``WlTrace`` object.
     """
-    with open(path, 'rb') as f:
-        magic = f.read(MAGIC_LEN)
-    if magic not in FILE_TYPE_HANDLER:
-        raise Exception('Unknown file magic: %s' % (binascii.hexlify(magic)))
-
-    return FILE_TYPE_HANDLER[magic](path, *args, **kwargs)
+    handler = kwargs.pop('handler', None)
+    if handler is not None:
+        return handler(path, *args, **kwargs)
+
+    # the same file object is handed over to the handler, instead of opening
+    # the file again.
+    f = io.open(path, 'rb', buffering=0)
+    magic = f.read(MAGIC_LEN)
+    handler = FILE_TYPE_HANDLER.get(magic)
+    if handler is None:
+        f.close()
+        raise Exception('Unknown file magic: %s' % (magic.encode('hex')))
+
+    f.seek(0)
+    return handler(path, fh=f, *args, **kwargs)